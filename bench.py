@@ -0,0 +1,189 @@
+import sys, os, json, re, random, time, shutil, subprocess, tempfile, argparse, platform, contextlib, io
+from dataclasses import dataclass
+
+import repos
+
+# NOTE(blackedout): Generates a synthetic cohort (local bare repositories used as ssh urls, rating files with random scores and feedback)
+# in a temporary directory and times every repos.py command end to end, plus the parsing and rendering phases on their own.
+# The results are written as json so that runs of different versions can be compared, e.g.
+# python3 bench.py --groups 150 --sheets 12 --output bench.json
+
+GROUP_PREFIX = "group"
+
+
+@dataclass
+class Timing:
+    name: str
+    seconds: float
+    count: int
+
+
+def run_command(*argv: str):
+    # NOTE(blackedout): The output of the commands is not interesting here, only how long they take
+    with contextlib.redirect_stdout(io.StringIO()):
+        repos.main(["repos.py", *argv])
+
+
+def git(dir: str|None, *args: str):
+    subprocess.run(["git", *args], cwd=dir, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def create_remotes(root: str, group_count: int, template_file_size: int):
+    template_dir = os.path.join(root, "template")
+    os.makedirs(template_dir)
+    git(template_dir, "init", "-q", "-b", "main")
+    with open(os.path.join(template_dir, "README.md"), "w") as file:
+        file.write("# Exercises\n\nSome template text.\n")
+    with open(os.path.join(template_dir, "exercise.pdf"), "wb") as file:
+        file.write(os.urandom(template_file_size))
+    git(template_dir, "add", ".")
+    git(template_dir, "-c", "user.name=bench", "-c", "user.email=bench@localhost", "commit", "-q", "-m", "template")
+
+    project_urls = []
+    for i in range(group_count):
+        name = f"{GROUP_PREFIX}{i:03d}"
+        url = os.path.join(root, "remotes", f"{name}.git")
+        git(None, "clone", "-q", "--bare", template_dir, url)
+        project_urls.append({ "name": f"{name} - Group {i}", "ssh": url })
+    shutil.rmtree(template_dir)
+
+    with open(repos.REPOS_JSON_FILENAME, "w", encoding="utf-8") as file:
+        json.dump(project_urls, file, ensure_ascii=False, indent=4)
+
+
+def disk_usage(path: str):
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        size += sum([os.lstat(os.path.join(dirpath, filename)).st_size for filename in filenames])
+    return size
+
+
+def task_args(task_count: int, subtask_count: int):
+    subtasks = "abcdefghijklmnopqrstuvwxyz"[:subtask_count]
+    return [f"{task}:{subtasks if task < task_count else 'FILE'}:10" for task in range(1, task_count + 1)]
+
+
+def fill_ratings_md(sheet_number: int, feedback_lines: int, rng: random.Random):
+    # NOTE(blackedout): Puts random points into the score row of every group (with a matching total) and some feedback below each task
+    filename = repos.ratings_md_filename(sheet_number)
+    with open(filename) as file:
+        lines = file.readlines()
+
+    filled = []
+    for line in lines:
+        if line.startswith("|") and "**0/" in line:
+            cells = line.strip().strip("|").split("|")
+            total = 0
+            new_cells = []
+            for cell in cells[:-1]:
+                max_points = int(re.search(r"/(\d+)", cell).group(1))
+                points = rng.randint(0, max_points)
+                total += points
+                new_cells.append(f" **{points}/{max_points}** ")
+            max_total = cells[-1].strip().strip("*").split("/")[1]
+            new_cells.append(f" **{total}/{max_total}** ")
+            line = "|" + "|".join(new_cells) + "|\n"
+        filled.append(line)
+        if line.startswith(f"#### {repos.TASK_STRING}"):
+            filled += [f"Feedback line {i}, {rng.random():.6f} **-1 P**\n" for i in range(feedback_lines)]
+
+    with open(filename, "w") as file:
+        file.writelines(filled)
+
+
+def benchmark(args: argparse.Namespace):
+    rng = random.Random(args.seed)
+    timings = []
+
+    def timed(name: str, f: callable, *f_args, count: int=1):
+        start = time.perf_counter()
+        result = f(*f_args)
+        timings.append(Timing(name, time.perf_counter() - start, count))
+        print(f"{name:<32} {timings[-1].seconds:8.3f}s", file=sys.stderr)
+        return result
+
+    timed("setup remotes", create_remotes, os.getcwd(), args.groups, args.template_size, count=args.groups)
+    jobs = ["--jobs", str(args.jobs)]
+
+    # NOTE(blackedout): file:// urls, otherwise git copies local repositories directly and ignores --filter and --depth
+    if args.clone_options:
+        with open(repos.REPOS_JSON_FILENAME) as file:
+            project_urls = json.load(file)
+        with open(repos.REPOS_JSON_FILENAME, "w", encoding="utf-8") as file:
+            json.dump([{ **p, "ssh": f"file://{p['ssh']}" } for p in project_urls], file, ensure_ascii=False, indent=4)
+    clone_options = args.clone_options.split()
+    timed("clone", run_command, "clone", *jobs, *clone_options, count=args.groups)
+    disk_bytes = disk_usage(os.getcwd()) - disk_usage("remotes")
+    print(f"{'clone disk usage':<32} {disk_bytes/1e6:8.3f}MB", file=sys.stderr)
+    timed("pull", run_command, "pull", *jobs, *(["--shared"] if "--shared" in clone_options else []), count=args.groups)
+    for sheet_number in range(1, args.sheets + 1):
+        timed(f"saveh {sheet_number}", run_command, "saveh", str(sheet_number), *jobs, count=args.groups)
+        timed(f"rmd {sheet_number}", run_command, "rmd", str(sheet_number), *task_args(args.tasks, args.subtasks), count=args.groups)
+        fill_ratings_md(sheet_number, args.feedback_lines, rng)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        parsed_sheets = timed("phase parse_bew_file", lambda: [repos.parse_bew_file(i) for i in range(1, args.sheets + 1)], count=args.groups*args.sheets)
+        group_names = sorted(parsed_sheets[0][1].keys())
+        matrix = timed("phase ScoreMatrix", repos.ScoreMatrix, group_names, [scores for _, scores in parsed_sheets], count=args.groups)
+        timed("phase gen_markdown_lr", lambda: [repos.gen_markdown_lr(matrix.scores(i)) for i in range(len(group_names))], count=args.groups)
+
+    last_sheet = str(args.sheets)
+    run_command("cache", "clear")
+    timed("commit preview (uncached)", run_command, "commit", last_sheet, "PREVIEW", count=args.groups)
+    timed("commit preview (cached)", run_command, "commit", last_sheet, "PREVIEW", count=args.groups)
+    timed("commit SUMMARY", run_command, "commit", last_sheet, "SUMMARY", count=args.groups)
+    timed("commit COMMIT", run_command, "commit", last_sheet, "COMMIT", *jobs, count=args.groups)
+    timed("commit COMMIT (unchanged)", run_command, "commit", last_sheet, "COMMIT", *jobs, count=args.groups)
+    return timings, disk_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times every repos.py command on a synthetic cohort.")
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--sheets", type=int, default=4)
+    parser.add_argument("--tasks", type=int, default=4)
+    parser.add_argument("--subtasks", type=int, default=3)
+    parser.add_argument("--feedback-lines", type=int, default=5)
+    parser.add_argument("--template-size", type=int, default=64*1024, help="size in bytes of the binary file in the template repository")
+    parser.add_argument("--jobs", type=int, default=repos.DEFAULT_JOBS)
+    parser.add_argument("--clone-options", default="", help="options passed on to clone, e.g. '--shared --filter blob:limit=1m'")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true", help="keep the generated fixture directory")
+    parser.add_argument("--output", default=None, help="json file for the results, printed if not set")
+    args = parser.parse_args()
+
+    repos.PROJECT_NAME_PATTERN_STRING = f"{GROUP_PREFIX}[0-9]+"
+    repos.PATTERNS = repos.compile_patterns()
+    version = subprocess.run(["git", "describe", "--always", "--dirty"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True).stdout.strip()
+
+    cwd = os.getcwd()
+    root = tempfile.mkdtemp(prefix="tutorstuff-bench-")
+    try:
+        os.chdir(root)
+        # NOTE(blackedout): Commits in the fixture must not depend on (or be signed with) the global git config
+        os.environ.update({ "GIT_CONFIG_GLOBAL": os.devnull, "GIT_AUTHOR_NAME": "bench", "GIT_AUTHOR_EMAIL": "bench@localhost", "GIT_COMMITTER_NAME": "bench", "GIT_COMMITTER_EMAIL": "bench@localhost" })
+        timings, disk_bytes = benchmark(args)
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print(f"Fixture kept in '{root}'", file=sys.stderr)
+        else:
+            shutil.rmtree(root)
+
+    results = {
+        "version": version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": vars(args),
+        "clone_disk_bytes": disk_bytes,
+        "timings": [{ "name": t.name, "seconds": t.seconds, "count": t.count, "seconds_per_item": t.seconds/t.count } for t in timings],
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=4)
+    else:
+        print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
-import sys, os, json, re
-from dataclasses import dataclass
+import sys, os, json, re, subprocess, time, sqlite3, hashlib, threading, mmap, signal
+from contextlib import contextmanager
+from dataclasses import dataclass, field, asdict, astuple
+from concurrent.futures import ThreadPoolExecutor
 
 # NOTE(blackedout): If you are using a gpg key to sign your commits you might want to run
 # gpg -s --default-key <your extra extra very very long key id> signtest
@@ -21,7 +23,8 @@ GROUP_ID = 0
 # and you are only assigned the ones with tutor1 prefix, you could set this to "tutor1-group[0-9]+"
 PROJECT_NAME_PATTERN_STRING = ""
 
-# NOTE(blackedout): The name of the file that will store group info such as name, ssh project url and scored commit ids
+# NOTE(blackedout): The name of the json file with group info such as name, ssh project url and scored commit ids.
+# All commands use the STATE_FILENAME database, this file is only imported once (if the database has no repos yet) and can be exported with the state command
 REPOS_JSON_FILENAME = "repos.json"
 
 # NOTE(blackedout): Prefix of the files where you will put in the rating of each group (comments and scored points)
@@ -42,6 +45,47 @@ CORRECTION_STRING = "Korrektur"
 POINTS_FROM_STRING = lambda points: float(points.replace(",", "."))
 POINTS_TO_STRING = lambda points: f"{points:g}"
 
+# NOTE(blackedout): File that caches name and ssh url of every group project by id and last_activity_at, such that get only fetches changed projects
+GITLAB_CACHE_FILENAME = "gitlab_cache.json"
+GITLAB_PAGE_SIZE = 100
+
+# NOTE(blackedout): SQLite file next to REPOS_JSON_FILENAME that stores the repos, graded commit hashes, parsed scores and push status
+# and caches parsed rating files, such that only edited sheets get parsed again
+STATE_FILENAME = os.path.join(os.path.dirname(REPOS_JSON_FILENAME), "state.sqlite")
+
+# NOTE(blackedout): Bare repository that stores the objects the student repos have in common (they are all forked from the same template).
+# clone --shared uses it as reference (the clones borrow its objects, so it must not be deleted) and pull --shared keeps it up to date
+SHARED_OBJECTS_DIRNAME = ".shared-objects.git"
+
+# NOTE(blackedout): Number of git processes (or GitLab requests, tests) that run at the same time, can be overridden with --jobs N
+DEFAULT_JOBS = (os.cpu_count() or 1)*4
+
+# NOTE(blackedout): How often a git network operation is retried if it failed with one of the TRANSIENT_GIT_ERRORS
+GIT_RETRIES = 2
+TRANSIENT_GIT_ERRORS = re.compile(r"Could not resolve host|Connection (?:timed out|reset|refused)|early EOF|remote end hung up|Operation timed out|unable to access")
+
+# NOTE(blackedout): Seconds between checks of the rating file for changes in watch mode
+WATCH_INTERVAL = 0.2
+
+# NOTE(blackedout): Number of slowest steps that are printed with --profile
+PROFILE_REPORT_COUNT = 15
+
+# NOTE(blackedout): Branches searched (in this order) by saveh --deadline, the first one that exists is used
+DEADLINE_REFS = ["refs/remotes/origin/main", "refs/heads/main", "HEAD"]
+
+# NOTE(blackedout): Number of files (with the most changed lines) that are listed in the change summary that changes --rmd puts in the rating file
+CHANGES_SUMMARY_FILE_COUNT = 5
+
+# NOTE(blackedout): Shell command that tests the submission of a group, it runs in a checkout of the saved commit of the sheet
+# ({group} and {sheet} are replaced). Lines it prints like "Aufgabe 2: 3,5" can be put into the rating file with test --prefill
+TEST_COMMAND = ""
+# NOTE(blackedout): Limits of each test run: wall clock seconds, cpu seconds and address space bytes (0 for no limit)
+TEST_TIMEOUT = 120
+TEST_CPU_LIMIT = 60
+TEST_MEMORY_LIMIT = 2*1024**3
+# NOTE(blackedout): Directory with one reusable git worktree per group in which the tests run
+TEST_WORKTREES_DIRNAME = ".worktrees"
+
 
 # MARK: UTIL
 @dataclass
@@ -51,6 +95,8 @@ class Command:
     arg_names: list[str]
     repeat_last_arg: bool
     example_usage: str|None
+    # NOTE(blackedout): Maps option names (without --) to their default value. Bool options are flags, all others take a value
+    options: dict = field(default_factory=dict)
 
 
 @dataclass
@@ -61,98 +107,446 @@ class Score:
     max_master: float
 
 
+@dataclass
+class GitResult:
+    returncode: int
+    stdout: str
+    stderr: str
+
+    @property
+    def output(self):
+        # NOTE(blackedout): Only for showing to the user, parse stdout instead (stderr may contain warnings)
+        return self.stdout + self.stderr
+
+
+@dataclass
+class RepoResult:
+    dirname: str
+    status: str
+    seconds: float
+    output: str
+
+
+@dataclass
+class Span:
+    name: str
+    start: float
+    seconds: float
+    thread_id: int
+    args: dict
+
+
+class Tracer:
+    # NOTE(blackedout): Records how long each step took if enabled (--profile or --trace FILE), the args dict
+    # returned by span can be filled with more info (e.g. exit codes) until the step ended
+    def __init__(self):
+        self.enabled = False
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, **args):
+        if not self.enabled:
+            yield args
+            return
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            span = Span(name, start - self.origin, time.perf_counter() - start, threading.get_ident(), args)
+            with self.lock:
+                self.spans.append(span)
+
+    def print_report(self, count: int):
+        print(f"\n{'Time':>9} | Step")
+        for span in sorted(self.spans, key=lambda span: span.seconds, reverse=True)[:count]:
+            args_string = " ".join([f"{key}={value}" for key, value in span.args.items()])
+            print(f"{span.seconds:>8.3f}s | {span.name} {args_string}")
+
+    def write_chrome_trace(self, path: str):
+        # NOTE(blackedout): Can be opened with chrome://tracing or https://ui.perfetto.dev
+        thread_numbers = {}
+        events = []
+        for span in self.spans:
+            thread_number = thread_numbers.setdefault(span.thread_id, len(thread_numbers))
+            events.append({ "name": span.name, "ph": "X", "ts": span.start*1e6, "dur": span.seconds*1e6, "pid": os.getpid(), "tid": thread_number, "args": { key: str(value) for key, value in span.args.items() } })
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump({ "traceEvents": events, "displayTimeUnit": "ms" }, file)
+
+TRACER = Tracer()
+
+
 def print_exit(message: str):
     print(message)
     sys.exit()
 
 
-def parse_bew_file(blatt_num):
+@contextmanager
+def atomic_write(filename: str, encoding: str|None=None):
+    # NOTE(blackedout): Writes into a temporary file that only replaces filename once everything was written
+    temp_filename = f"{filename}.tmp"
+    try:
+        with open(temp_filename, "w", encoding=encoding) as file:
+            yield file
+        os.replace(temp_filename, filename)
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+
+def repo_dirname(repo: dict):
+    return repo["name"].split()[0]
+
+
+def run_git(dir: str|None, *args: str, retries: int=0, env: dict|None=None):
+    with TRACER.span(f"git {args[0]}", dir=dir) as span_args:
+        for attempt in range(retries + 1):
+            process = subprocess.run(["git", *args], cwd=dir, capture_output=True, stdin=subprocess.DEVNULL, text=True, env={ **os.environ, **env } if env else None)
+            if process.returncode == 0 or not TRANSIENT_GIT_ERRORS.search(process.stderr):
+                break
+            if attempt < retries:
+                time.sleep(2**attempt)
+        span_args.update(exit=process.returncode, attempts=attempt + 1)
+    return GitResult(process.returncode, process.stdout, process.stderr)
+
+
+def run_repos(f: callable, repos: list[dict], jobs: int):
+    # NOTE(blackedout): f gets called with the repo dict and must return a (status, output) tuple, any exception counts as failed
+    def run_repo(repo: dict):
+        start = time.perf_counter()
+        with TRACER.span(f"repo {repo_dirname(repo)}") as span_args:
+            try:
+                status, output = f(repo)
+            except Exception as e:
+                status, output = "failed", f"{type(e).__name__}: {e}"
+            span_args["status"] = status
+        result = RepoResult(repo_dirname(repo), status, time.perf_counter() - start, output)
+        print(f"{result.status:>9} {result.dirname}")
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        return list(executor.map(run_repo, repos))
+
+
+def print_repo_results(results: list[RepoResult]):
+    if not results:
+        return
+    name_width = max([len(r.dirname) for r in results] + [4])
+    print()
+    print(f"{'Repo':<{name_width}} | {'Status':<9} | {'Time':>8}")
+    print(f"{'-'*name_width}-+-{'-'*9}-+-{'-'*8}")
+    for r in results:
+        print(f"{r.dirname:<{name_width}} | {r.status:<9} | {r.seconds:>7.2f}s")
+
+    counts = {}
+    for r in results:
+        counts[r.status] = counts.get(r.status, 0) + 1
+    print(", ".join([f"{count} {status}" for status, count in sorted(counts.items())]))
+
+    for r in results:
+        if r.status == "failed":
+            print(f"\n--- {r.dirname} ---\n{r.output.strip()}")
+
+
+@dataclass
+class Patterns:
+    group: re.Pattern
+    sheet: re.Pattern
+    task: re.Pattern
+    total: re.Pattern
+    master: re.Pattern
+    cell_separator: re.Pattern
+    points: re.Pattern
+    changes: re.Pattern
+    readme_ratings: re.Pattern
+
+
+def compile_patterns():
+    # NOTE(blackedout): Must be called again if the config strings are changed at runtime
+    return Patterns(
+        group=re.compile(f"^# ({PROJECT_NAME_PATTERN_STRING})"),
+        sheet=re.compile(f"### {SHEET_STRING} ([0-9]+)"),
+        task=re.compile(rf"{TASK_STRING} (\d+)"),
+        total=re.compile(TOTAL_STRING),
+        master=re.compile(MASTER_STRING),
+        cell_separator=re.compile(r"\s*\|\s*"),
+        points=re.compile(r"\*\*(\d+[,\.]?\d*)\/(\d+[,\.]?\d*)\*\*"),
+        changes=re.compile(r"^<!-- changes: .* -->$"),
+        readme_ratings=re.compile(rf"### (?:{SHEET_STRING} \d+|{TOTAL_SCORE_STRING})"),
+    )
+
+PATTERNS = compile_patterns()
+
+
+def ratings_md_filename(sheet_number: int):
+    return f"{RATINGS_FILEPREFIX}{sheet_number:02d}.md"
+
+
+def parse_bew_lines(lines, blatt_num: int, first_line_number: int=1, report: callable=print):
+    # NOTE(blackedout): Yields a (group, bew_string, Score) tuple as soon as the section of a group ended.
+    # Problems are passed to report (printed by default) together with their line number, groups without a valid total score are not yielded.
+    p = PATTERNS
+    max_aufgaben_scores = None
+    curr_group = None
+    bew_lines = []
+    sheet_line_number = None
+    aufgaben_string = None
+    group_score = {}
+    group_line_number = None
+
+    def end_group():
+        nonlocal max_aufgaben_scores
+        if "g" not in group_score:
+            report(f"MISSING TOTAL SCORE {blatt_num} {curr_group} (line {group_line_number})")
+            return None
+
+        score_sum = 0.0
+        max_score_sum = 0.0
+        group_max_aufgaben_scores = {}
+        for ex_key, (score, max_score) in group_score.items():
+            if isinstance(ex_key, int):
+                score_sum += score
+                max_score_sum += max_score
+            group_max_aufgaben_scores[ex_key] = max_score
+        if score_sum != group_score["g"][0]:
+            report(f"SCORE MISMATCH {blatt_num} {curr_group} (line {sheet_line_number + 3})")
+        if max_score_sum != group_score["g"][1]:
+            report(f"MAX SCORE MISMATCH {blatt_num} {curr_group} (line {sheet_line_number + 3})")
+
+        if max_aufgaben_scores is None:
+            max_aufgaben_scores = group_max_aufgaben_scores
+        elif max_aufgaben_scores != group_max_aufgaben_scores:
+            report(f"TASK MISMATCH {blatt_num} {curr_group} (line {sheet_line_number + 1})")
+
+        score = Score(*group_score["g"], *(group_score["m"] if "m" in group_score else (0.0, 0.0)))
+        return curr_group, "".join(bew_lines).strip(), score
+
+    for line_number, line in enumerate(lines, first_line_number):
+        matched = p.group.match(line)
+        if matched:
+            if curr_group is not None:
+                record = end_group()
+                if record:
+                    yield record
+
+            curr_group = matched.group(1)
+            group_line_number = line_number
+            bew_lines = []
+            sheet_line_number = None
+            group_score = {}
+        elif curr_group is not None:
+            # NOTE(blackedout): Change summaries inserted by changes --rmd are only meant for the grader
+            if p.changes.match(line):
+                continue
+            bew_lines.append(line)
+
+            if sheet_line_number is None:
+                title_match = p.sheet.match(line)
+                if title_match:
+                    sheet_line_number = line_number
+                    if int(title_match.group(1)) != blatt_num:
+                        report(f"SHEET MISMATCH {blatt_num} {curr_group} (line {line_number})")
+            elif line_number == sheet_line_number + 1:
+                aufgaben_string = line
+            elif line_number == sheet_line_number + 3:
+                aufgaben_split = p.cell_separator.split(aufgaben_string)[1:-1]
+                punkte_split = p.cell_separator.split(line)[1:-1]
+                if len(aufgaben_split) != len(punkte_split):
+                    report(f"COLUMN MISMATCH {blatt_num} {curr_group} (line {line_number})")
+
+                for aufgabe_name, punkte_string in zip(aufgaben_split, punkte_split):
+                    punkte_match = p.points.match(punkte_string)
+                    if not punkte_match:
+                        report(f"INVALID POINTS '{punkte_string}' {blatt_num} {curr_group} (line {line_number})")
+                        continue
+                    this_score = POINTS_FROM_STRING(punkte_match.group(1))
+                    max_score = POINTS_FROM_STRING(punkte_match.group(2))
+                    aufgabe_match = p.task.match(aufgabe_name)
+                    if aufgabe_match:
+                        group_score[int(aufgabe_match.group(1))] = (this_score, max_score)
+                    elif p.total.match(aufgabe_name):
+                        group_score["g"] = (this_score, max_score)
+                    elif p.master.match(aufgabe_name):
+                        group_score["m"] = (this_score, max_score)
+
+    if curr_group is not None:
+        record = end_group()
+        if record:
+            yield record
+
+
+def split_group_sections(lines: list[str]):
+    # NOTE(blackedout): Returns the lines of each group section (starting with its # header) and the line number of the header
+    sections = {}
+    curr_group = None
+    for line_number, line in enumerate(lines, 1):
+        matched = PATTERNS.group.match(line)
+        if matched:
+            curr_group = matched.group(1)
+            sections[curr_group] = (line_number, [])
+        if curr_group is not None:
+            sections[curr_group][1].append(line)
+    return sections
+
+
+def iter_bew_file(blatt_num: int, report: callable=print):
+    with open(ratings_md_filename(blatt_num), "r") as file:
+        yield from parse_bew_lines(file, blatt_num, report=report)
+
+
+def parse_bew_file(blatt_num: int, report: callable=print):
     bew_strings = {}
     scores = {}
-    with open(f"{RATINGS_FILEPREFIX}{blatt_num:02d}.md", "r") as file:
-        lines = file.readlines()
+    for group, bew_string, score in iter_bew_file(blatt_num, report):
+        bew_strings[group] = bew_string
+        scores[group] = score
+    return bew_strings, scores
 
-        curr_group = None
-        bew_string = None
-        max_aufgaben_scores = None
-        group_aufgaben_string = None
-        group_punkte_string = None
-        group_score = {}
-
-        def end_group(max_aufgaben_scores):
-            bew_strings[curr_group] = bew_string.strip()
-            scores[curr_group] = Score(*group_score["g"], *(group_score["m"] if "m" in group_score else (0.0, 0.0)))
-
-            score_sum = 0.0
-            max_score_sum = 0.0
-            group_max_aufgaben_scores = {}
-            for ex_key, (score, max_score) in group_score.items():
-                if isinstance(ex_key, int):
-                    score_sum += score
-                    max_score_sum += max_score
-                group_max_aufgaben_scores[ex_key] = max_score
-            if score_sum != group_score["g"][0]:
-                print(f"SCORE MISMATCH {blatt_num} {curr_group}")
-            if max_score_sum != group_score["g"][1]:
-                print(f"MAX SCORE MISMATCH {blatt_num} {curr_group}")
-
-            if max_aufgaben_scores is None:
-                max_aufgaben_scores = group_max_aufgaben_scores
-            else:
-                assert(max_aufgaben_scores == group_max_aufgaben_scores)
 
-        for i in range(len(lines)):
-            line = lines[i]
-            matched = re.match(f"^# ({PROJECT_NAME_PATTERN_STRING})", line)
-            if matched:
-                if bew_string:
-                    end_group(max_aufgaben_scores)
+def open_state():
+    connection = sqlite3.connect(STATE_FILENAME)
+    connection.executescript("""
+        CREATE TABLE IF NOT EXISTS repos (dirname TEXT PRIMARY KEY, name TEXT NOT NULL, ssh TEXT NOT NULL, position INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS hashes (dirname TEXT, sheet INTEGER, commit_hash TEXT NOT NULL, PRIMARY KEY (dirname, sheet));
+        CREATE INDEX IF NOT EXISTS hashes_by_sheet ON hashes (sheet);
+        CREATE TABLE IF NOT EXISTS scores (dirname TEXT, sheet INTEGER, num REAL, max REAL, num_master REAL, max_master REAL, PRIMARY KEY (dirname, sheet));
+        CREATE INDEX IF NOT EXISTS scores_by_sheet ON scores (sheet);
+        CREATE TABLE IF NOT EXISTS readme_pushes (dirname TEXT, sheet INTEGER, sha256 TEXT, status TEXT, updated_at REAL, PRIMARY KEY (dirname, sheet));
+        CREATE TABLE IF NOT EXISTS sheet_cache (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT, config TEXT, data TEXT);
+        CREATE TABLE IF NOT EXISTS test_results (commit_hash TEXT, command_sha256 TEXT, status TEXT, output TEXT, seconds REAL, PRIMARY KEY (commit_hash, command_sha256));
+        CREATE TABLE IF NOT EXISTS late_commits (dirname TEXT, sheet INTEGER, deadline REAL, count INTEGER, newest_timestamp INTEGER, PRIMARY KEY (dirname, sheet));
+        CREATE TABLE IF NOT EXISTS changes (from_hash TEXT, to_hash TEXT, data TEXT, PRIMARY KEY (from_hash, to_hash));
+        CREATE TABLE IF NOT EXISTS sheet_index (path TEXT, group_name TEXT, start INTEGER, end INTEGER, first_line_number INTEGER, size INTEGER, mtime_ns INTEGER, config TEXT, PRIMARY KEY (path, group_name));
+    """)
+    if connection.execute("SELECT COUNT(*) FROM repos").fetchone()[0] == 0 and os.path.exists(REPOS_JSON_FILENAME):
+        import_repos_json(connection)
+    return connection
+
+
+def import_repos_json(connection: sqlite3.Connection):
+    repos = json.load(open(REPOS_JSON_FILENAME))
+    with connection:
+        for position, repo in enumerate(repos):
+            dirname = repo_dirname(repo)
+            connection.execute("INSERT OR REPLACE INTO repos VALUES (?, ?, ?, ?)", (dirname, repo["name"], repo["ssh"], position))
+            for key, commit_hash in repo.items():
+                if key.isdigit():
+                    connection.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?)", (dirname, int(key), commit_hash))
+    print(f"Imported {len(repos)} repos from '{REPOS_JSON_FILENAME}' into '{STATE_FILENAME}'")
+
+
+def export_repos_json(connection: sqlite3.Connection):
+    repos = [{ key: value for key, value in repo.items() if key != "dirname" } for repo in load_repos(connection)]
+    with atomic_write(REPOS_JSON_FILENAME, encoding="utf-8") as file:
+        json.dump(repos, file, ensure_ascii=False, indent=4)
+    print(f"Exported {len(repos)} repos to '{REPOS_JSON_FILENAME}'")
+
+
+def load_repos(connection: sqlite3.Connection|None=None):
+    # NOTE(blackedout): Returns the repos in the same format as REPOS_JSON_FILENAME (commit hashes keyed by sheet number string) plus their dirname
+    connection = connection or open_state()
+    repos = {}
+    for dirname, name, ssh in connection.execute("SELECT dirname, name, ssh FROM repos ORDER BY position"):
+        repos[dirname] = { "name": name, "ssh": ssh, "dirname": dirname }
+    for dirname, sheet, commit_hash in connection.execute("SELECT dirname, sheet, commit_hash FROM hashes ORDER BY sheet"):
+        if dirname in repos:
+            repos[dirname][str(sheet)] = commit_hash
+    return list(repos.values())
+
+
+# NOTE(blackedout): Must be increased whenever parse_bew_lines (or the cached data) changes, so that no sheet parsed by an older version is used
+PARSER_VERSION = 2
+
+
+def parse_config_key():
+    # NOTE(blackedout): Cached sheets become invalid if any of the strings the parser depends on are changed or PARSER_VERSION is increased
+    return hashlib.sha256(repr((PARSER_VERSION, PROJECT_NAME_PATTERN_STRING, TASK_STRING, TOTAL_STRING, SHEET_STRING, MASTER_STRING)).encode()).hexdigest()
+
+
+def parse_bew_file_cached(blatt_num, connection: sqlite3.Connection):
+    path = ratings_md_filename(blatt_num)
+    stat = os.stat(path)
+    config = parse_config_key()
+    row = connection.execute("SELECT size, mtime_ns, sha256, config, data FROM sheet_cache WHERE path = ?", (path,)).fetchone()
+
+    is_hit = row is not None and row[3] == config and row[0] == stat.st_size and row[1] == stat.st_mtime_ns
+    if not is_hit:
+        with open(path, "rb") as file:
+            sha256 = hashlib.sha256(file.read()).hexdigest()
+        if row is not None and row[3] == config and row[2] == sha256:
+            is_hit = True
+            connection.execute("UPDATE sheet_cache SET size = ?, mtime_ns = ? WHERE path = ?", (stat.st_size, stat.st_mtime_ns, path))
+
+    if is_hit:
+        print(f"{path}: cached")
+        data = json.loads(row[4])
+        # NOTE(blackedout): The problems found while parsing are shown again until the file is fixed
+        for message in data["messages"]:
+            print(message)
+        return data["bew_strings"], { group: Score(**score) for group, score in data["scores"].items() }
+
+    print(f"{path}: parsed")
+    messages = []
+    def report(message: str):
+        print(message)
+        messages.append(message)
+
+    with TRACER.span("parse_bew_file", path=path):
+        bew_strings, scores = parse_bew_file(blatt_num, report)
+    data = json.dumps({ "bew_strings": bew_strings, "scores": { group: asdict(score) for group, score in scores.items() }, "messages": messages }, ensure_ascii=False)
+    connection.execute("INSERT OR REPLACE INTO sheet_cache VALUES (?, ?, ?, ?, ?, ?)", (path, stat.st_size, stat.st_mtime_ns, sha256, config, data))
+    connection.execute("DELETE FROM scores WHERE sheet = ?", (blatt_num,))
+    connection.executemany("INSERT INTO scores VALUES (?, ?, ?, ?, ?, ?)", [(group, blatt_num, *astuple(score)) for group, score in scores.items()])
+    return bew_strings, scores
+
 
+def index_sheet(blatt_num: int, connection: sqlite3.Connection):
+    # NOTE(blackedout): Returns the byte range and first line number of every group section in the rating file,
+    # the index is only rebuilt if the file (or the parser config) changed
+    path = ratings_md_filename(blatt_num)
+    stat = os.stat(path)
+    config = parse_config_key()
+    rows = connection.execute("SELECT group_name, start, end, first_line_number, size, mtime_ns, config FROM sheet_index WHERE path = ?", (path,)).fetchall()
+    if rows and all(row[4:] == (stat.st_size, stat.st_mtime_ns, config) for row in rows):
+        return { row[0]: row[1:4] for row in rows }
+
+    index = {}
+    curr_group = None
+    offset = 0
+    with open(path, "rb") as file:
+        for line_number, line in enumerate(file, 1):
+            matched = PATTERNS.group.match(line.decode())
+            if matched:
+                if curr_group is not None:
+                    index[curr_group] = (index[curr_group][0], offset, index[curr_group][2])
                 curr_group = matched.group(1)
-                bew_string = ""
-                group_blatt_num_line = None
-            elif curr_group:
-                bew_string += line
-
-                if not group_blatt_num_line:
-                    title_match = re.match(f"### {SHEET_STRING} ([0-9]+)", line)
-                    if title_match:
-                        group_blatt_num = int(title_match.group(1))
-                        group_blatt_num_line = i
-                        assert(group_blatt_num == blatt_num)
-                elif i == group_blatt_num_line + 1:
-                    group_aufgaben_string = line
-                elif i == group_blatt_num_line + 3:
-                    group_punkte_string = line
-                    
-                    group_aufgaben_split = re.split(r"\s*\|\s*", group_aufgaben_string)[1:-1]
-                    group_punkte_split = re.split(r"\s*\|\s*", group_punkte_string)[1:-1]
-                    assert(len(group_aufgaben_split) == len(group_punkte_split))
-
-                    group_score = {}
-                    for j in range(len(group_aufgaben_split)):
-                        aufgabe_name = group_aufgaben_split[j]
-                        punkte_string = group_punkte_split[j]
-
-                        punkte_match = re.match(r"\*\*(\d+[,\.]?\d*)\/(\d+[,\.]?\d*)\*\*", punkte_string)
-                        assert(punkte_match)
-                        this_score = POINTS_FROM_STRING(punkte_match.group(1))
-                        max_score = POINTS_FROM_STRING(punkte_match.group(2))
-                        aufgabe_match = re.match(rf"{TASK_STRING} (\d+)", aufgabe_name)
-                        gesamt_match = re.match(TOTAL_STRING, aufgabe_name)
-                        master_match = re.match(MASTER_STRING, aufgabe_name)
-                        if aufgabe_match:
-                            aufgabe_num = int(aufgabe_match.group(1))
-                            group_score[aufgabe_num] = (this_score, max_score)
-                        elif gesamt_match:
-                            group_score["g"] = (this_score, max_score)
-                        elif master_match:
-                            group_score["m"] = (this_score, max_score)
-        end_group(max_aufgaben_scores)
+                index[curr_group] = (offset, None, line_number)
+            offset += len(line)
+    if curr_group is not None:
+        index[curr_group] = (index[curr_group][0], offset, index[curr_group][2])
+
+    connection.execute("DELETE FROM sheet_index WHERE path = ?", (path,))
+    connection.executemany("INSERT INTO sheet_index VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [(path, group, *index[group], stat.st_size, stat.st_mtime_ns, config) for group in index])
+    return index
+
+
+def parse_group_section(blatt_num: int, group: str, connection: sqlite3.Connection):
+    # NOTE(blackedout): Same result as parse_bew_file, but only for one group whose section is read through the index
+    bew_strings = {}
+    scores = {}
+    index = index_sheet(blatt_num, connection)
+    if group in index:
+        start, end, first_line_number = index[group]
+        with open(ratings_md_filename(blatt_num), "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            section = mapped[start:end].decode()
+        for record_group, bew_string, score in parse_bew_lines(section.splitlines(keepends=True), blatt_num, first_line_number):
+            bew_strings[record_group] = bew_string
+            scores[record_group] = score
     return bew_strings, scores
 
 
-def gen_markdown_lr(scores: list[Score], add_master_points: bool=False, append_note: bool=False, print_summary: bool=False):
+def gen_markdown_lr(scores: list[Score], add_master_points: bool=False, append_note: bool=False):
     max_label = f"**{MAX_STRING}**"
     percent_label = f"**{PERCENT_STRING}**"
 
@@ -190,21 +584,6 @@ def gen_markdown_lr(scores: list[Score], add_master_points: bool=False, append_n
     markdown += content_entry(max_label, lbl_colwidth) + "".join([points_entry(s.max, num_colwidth) for s in scores]) + points_entry(sum_score.max, sum_colwidth, bold=True) + "|\n"
     markdown += content_entry(percent_label, lbl_colwidth) + "".join([percent_entry(s.num/s.max, num_colwidth) for s in scores]) + percent_entry(sum_score.num/sum_score.max, sum_colwidth, bold=True) + "|\n"
     
-    if print_summary:
-        bachelor_percent = sum_score.num/sum_score.max*100
-        print(f"{sum_score.num:g}/{sum_score.max:g} Punkte ({bachelor_percent:.3g} %)")
-        if sum_score.max_master > 0:
-            master_percent = sum_score.num_master/sum_score.max_master*100
-            print(f"{sum_score.num_master:g}/{sum_score.max_master:g} Masterpunkte ({master_percent:.3g} %)")
-        zulassung_string = "KEINE ZULASSUNG"
-        if bachelor_percent >= 50.0:
-            if sum_score.max_master > 0 and master_percent >= 50.0:
-                zulassung_string = "Masterzulassung"
-            else:
-                zulassung_string = "Bachelorzulassung"
-        print(f"=> {zulassung_string}")
-        print()
-
     if sum_score.max_master > 0:
         if add_master_points:
             master_prefix = "+"
@@ -226,6 +605,123 @@ def gen_markdown_lr(scores: list[Score], add_master_points: bool=False, append_n
     return markdown
 
 
+class ScoreMatrix:
+    # NOTE(blackedout): Scores of all groups and sheets in one array of shape groups x sheets x (num, max, num_master, max_master)
+    ADMISSION_STRINGS = ["KEINE ZULASSUNG", "Bachelorzulassung", "Masterzulassung"]
+
+    def __init__(self, groups: list[str], sheet_scores: list[dict[str, Score]]):
+        import numpy as np
+        self.groups = groups
+        self.values = np.array([[astuple(scores[group]) for scores in sheet_scores] for group in groups], dtype=float).reshape(len(groups), len(sheet_scores), 4)
+        self.totals = self.values.sum(axis=1)
+        self.percents = self.percent(self.totals[:, 0], self.totals[:, 1])
+        self.master_percents = self.percent(self.totals[:, 2], self.totals[:, 3])
+        has_master = self.totals[:, 3] > 0
+        admission = np.where(self.percents >= 50.0, np.where(has_master & (self.master_percents >= 50.0), 2, 1), 0)
+        self.admissions = [self.ADMISSION_STRINGS[a] for a in admission]
+
+    @staticmethod
+    def percent(num, max):
+        import numpy as np
+        return np.divide(num*100, max, out=np.full(np.shape(num), np.nan), where=max > 0)
+
+    def scores(self, i: int):
+        return [Score(*row) for row in self.values[i].tolist()]
+
+    def total(self, i: int):
+        return Score(*self.totals[i].tolist())
+
+    def sheet_statistics(self):
+        import numpy as np
+        sheet_percents = self.percent(self.values[:, :, 0], self.values[:, :, 1])
+        statistics = []
+        for j in range(self.values.shape[1]):
+            histogram, _ = np.histogram(sheet_percents[:, j], bins=10, range=(0, 100))
+            statistics.append({
+                "sheet": j + 1,
+                "mean": float(np.mean(self.values[:, j, 0])) if self.groups else None,
+                "median": float(np.median(self.values[:, j, 0])) if self.groups else None,
+                "max": float(self.values[0, j, 1]) if self.groups else None,
+                "histogram": histogram.tolist(),
+            })
+        return statistics
+
+    def to_json(self):
+        import numpy as np
+        groups = []
+        for i, group in enumerate(self.groups):
+            groups.append({
+                "group": group,
+                "sheets": [asdict(score) for score in self.scores(i)],
+                "total": asdict(self.total(i)),
+                "percent": None if np.isnan(self.percents[i]) else float(self.percents[i]),
+                "master_percent": None if np.isnan(self.master_percents[i]) else float(self.master_percents[i]),
+                "admission": self.admissions[i],
+            })
+        return { "groups": groups, "sheets": self.sheet_statistics() }
+
+    def write_csv(self, path: str):
+        import csv
+        with open(path, "w", newline="", encoding="utf-8") as file:
+            writer = csv.writer(file)
+            writer.writerow(["group"] + [f"{SHEET_STRING} {j + 1}" for j in range(self.values.shape[1])] + ["num", "max", "num_master", "max_master", "percent", "master_percent", "admission"])
+            for i, group in enumerate(self.groups):
+                writer.writerow([group] + [POINTS_TO_STRING(v) for v in self.values[i, :, 0].tolist()] + [POINTS_TO_STRING(v) for v in self.totals[i].tolist()] + [f"{p:.3g}" if p == p else "" for p in (self.percents[i], self.master_percents[i])] + [self.admissions[i]])
+
+
+def print_score_summary(matrix: ScoreMatrix, group_names: list[str]):
+    if not matrix.groups:
+        print("No groups to summarize.")
+        return
+    for i, name in enumerate(group_names):
+        total = matrix.total(i)
+        print(name)
+        print(f"{total.num:g}/{total.max:g} Punkte ({matrix.percents[i]:.3g} %)")
+        if total.max_master > 0:
+            print(f"{total.num_master:g}/{total.max_master:g} Masterpunkte ({matrix.master_percents[i]:.3g} %)")
+        print(f"=> {matrix.admissions[i]}")
+        print()
+
+    for statistics in matrix.sheet_statistics():
+        histogram_string = " ".join([f"{count:3}" for count in statistics["histogram"]])
+        print(f"{SHEET_STRING} {statistics['sheet']:2}: mean {statistics['mean']:5.3g} median {statistics['median']:5.3g} of {statistics['max']:g} | {histogram_string}")
+    counts_string = ", ".join([f"{matrix.admissions.count(a)} {a}" for a in ScoreMatrix.ADMISSION_STRINGS])
+    print(counts_string)
+
+
+def render_readme(readme: str, bew_strings: list[str], scores: list[Score]):
+    # NOTE(blackedout): Keeps everything of the existing README before the first rating section
+    readme_start = ""
+    for line in readme.splitlines(keepends=True):
+        if PATTERNS.readme_ratings.match(line):
+            break
+        readme_start += line
+
+    parts = [readme_start, gen_markdown_lr(scores, add_master_points=False, append_note=False)]
+    for bew_string in reversed(bew_strings):
+        parts.append("\n\n" + bew_string)
+    parts.append("\n")
+    return "".join(parts)
+
+
+def insert_commit_hash(bew_string: str, commit_hash: str):
+    return bew_string.replace("Commit \n", f"Commit {commit_hash}\n")
+
+
+def update_readme(dir: str, bew_strings: list[str], scores: list[Score]):
+    # NOTE(blackedout): Returns the sha256 of the rendered README and whether it had to be written (it is left alone if nothing changed)
+    readme_path = os.path.join(dir, "README.md")
+    with open(readme_path, "r") as file:
+        readme = file.read()
+    new_readme = render_readme(readme, bew_strings, scores)
+    readme_hash = hashlib.sha256(new_readme.encode()).hexdigest()
+    if new_readme == readme:
+        return readme_hash, False
+    with open(readme_path, "w") as file:
+        file.write(new_readme)
+    return readme_hash, True
+
+
 def parse_sheet_number(arg: str):
     try:
         blatt_num = int(arg)
@@ -237,82 +733,373 @@ def parse_sheet_number(arg: str):
 # MARK: COMMAND get
 def get_repos(command: Command, args: list[str]):
     import gitlab
+    from itertools import islice
 
     with open(TOKEN_FILENAME) as token_file:
-        gitlab_token = token_file.read()
+        gitlab_token = token_file.read().strip()
     
     gl = gitlab.Gitlab(url=GITLAB_SERVER_URL, private_token=gitlab_token)
-    group = gl.groups.get(GROUP_ID)
-    group_projects = group.projects.list(get_all=True, iterator=True)
+    group = gl.groups.get(GROUP_ID, lazy=True)
+    jobs = max(command.options["jobs"], 1)
+
+    # NOTE(blackedout): The first page tells how many pages there are, the remaining ones are then fetched at the same time
+    with TRACER.span("gitlab list projects") as span_args:
+        first_page = group.projects.list(iterator=True, per_page=GITLAB_PAGE_SIZE)
+        span_args["pages"] = first_page.total_pages
+        if first_page.total_pages is None:
+            group_projects = list(first_page)
+        else:
+            group_projects = list(islice(first_page, GITLAB_PAGE_SIZE))
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                pages = executor.map(lambda page: group.projects.list(page=page, per_page=GITLAB_PAGE_SIZE, get_all=False), range(2, first_page.total_pages + 1))
+                for page in pages:
+                    group_projects += page
+
+    cache = {}
+    if os.path.exists(GITLAB_CACHE_FILENAME):
+        cache = json.load(open(GITLAB_CACHE_FILENAME))
+
+    # NOTE(blackedout): The project listing already contains name and ssh url, only projects where it doesn't and that changed since the last run are requested separately
+    projects = {}
+    detail_ids = []
+    for gp in group_projects:
+        id = str(gp.get_id())
+        last_activity_at = gp.attributes.get("last_activity_at")
+        cached = cache.get(id)
+        if "name" in gp.attributes and "ssh_url_to_repo" in gp.attributes:
+            projects[id] = { "name": gp.name, "ssh": gp.ssh_url_to_repo, "last_activity_at": last_activity_at }
+        elif cached and last_activity_at is not None and cached["last_activity_at"] == last_activity_at:
+            projects[id] = cached
+        else:
+            detail_ids.append(id)
+    
+    if detail_ids:
+        print(f"Requesting {len(detail_ids)} of {len(group_projects)} projects separately")
+        with TRACER.span("gitlab get projects", count=len(detail_ids)), ThreadPoolExecutor(max_workers=jobs) as executor:
+            for id, project in zip(detail_ids, executor.map(gl.projects.get, detail_ids)):
+                projects[id] = { "name": project.name, "ssh": project.ssh_url_to_repo, "last_activity_at": project.last_activity_at }
+
+    with open(GITLAB_CACHE_FILENAME, "w", encoding="utf-8") as file:
+        json.dump(projects, file, ensure_ascii=False, indent=4)
 
     project_urls = []
-    for gp in group_projects:
-        project = gl.projects.get(gp.get_id())
-        if re.match(f"^{PROJECT_NAME_PATTERN_STRING}", project.name):
-            project_urls.append({ "name": project.name, "ssh": project.ssh_url_to_repo })
+    for project in projects.values():
+        if re.match(f"^{PROJECT_NAME_PATTERN_STRING}", project["name"]):
+            project_urls.append({ "name": project["name"], "ssh": project["ssh"] })
 
     project_urls.sort(key=lambda x: x["ssh"])
-    with open(REPOS_JSON_FILENAME, "w", encoding="utf-8") as file:
-        json.dump(project_urls, file, ensure_ascii=False, indent=4)
+    # NOTE(blackedout): Replaces the repos in one transaction, commit hashes that were already saved are kept
+    with open_state() as connection:
+        connection.execute("DELETE FROM repos")
+        connection.executemany("INSERT INTO repos VALUES (?, ?, ?, ?)", [(repo_dirname(p), p["name"], p["ssh"], i) for i, p in enumerate(project_urls)])
+    print(f"Saved {len(project_urls)} repos in '{STATE_FILENAME}'")
 
 
 # MARK: COMMAND clone
+def update_shared_objects(repos: list[dict], jobs: int):
+    if not os.path.exists(SHARED_OBJECTS_DIRNAME):
+        run_git(None, "init", "-q", "--bare", SHARED_OBJECTS_DIRNAME)
+        # NOTE(blackedout): The clones depend on these objects, so they must never be pruned
+        run_git(SHARED_OBJECTS_DIRNAME, "config", "gc.pruneExpire", "never")
+
+    def fetch_repo(repo: dict):
+        result = run_git(SHARED_OBJECTS_DIRNAME, "fetch", "--no-tags", repo["ssh"], f"+refs/heads/*:refs/remotes/{repo_dirname(repo)}/*", retries=GIT_RETRIES)
+        return "ok" if result.returncode == 0 else "failed", result.output
+
+    # NOTE(blackedout): The first repo is fetched alone such that the template history is only transferred once
+    print(f"Updating '{SHARED_OBJECTS_DIRNAME}'")
+    results = run_repos(fetch_repo, repos[:1], 1) + run_repos(fetch_repo, repos[1:], jobs)
+    failed_count = len([r for r in results if r.status == "failed"])
+    if failed_count > 0:
+        print(f"{failed_count} repos could not be fetched into '{SHARED_OBJECTS_DIRNAME}', they will transfer all their objects themselves")
+    print()
+
+
 def clone_repos(command: Command, args: list[str]):
-    data = json.load(open(REPOS_JSON_FILENAME))
-    for repo in data:
-        url = repo["ssh"]
-        os.system("git clone " + url)
+    repos = load_repos()
+    clone_args = []
+    if command.options["shared"]:
+        update_shared_objects(repos, command.options["jobs"])
+        clone_args += ["--reference", SHARED_OBJECTS_DIRNAME]
+    if command.options["filter"]:
+        clone_args.append(f"--filter={command.options['filter']}")
+    if command.options["depth"] > 0:
+        clone_args += ["--depth", str(command.options["depth"])]
+
+    def clone_repo(repo: dict):
+        dir = repo_dirname(repo)
+        if os.path.exists(dir):
+            return "unchanged", f"'{dir}' does already exist."
+        result = run_git(None, "clone", *clone_args, repo["ssh"], dir, retries=GIT_RETRIES)
+        return "ok" if result.returncode == 0 else "failed", result.output
+
+    print_repo_results(run_repos(clone_repo, repos, command.options["jobs"]))
 
 
 # MARK: COMMAND pull
 def pull_repos(command: Command, args: list[str]):
-    data = json.load(open(REPOS_JSON_FILENAME))
-    for repo in data:
-        dir = repo["name"].split()[0]
-        print(dir)
-        os.system(f"cd {dir} && git pull")
+    def pull_repo(repo: dict):
+        dir = repo_dirname(repo)
+        head_before = run_git(dir, "rev-parse", "HEAD").stdout
+        result = run_git(dir, "pull", retries=GIT_RETRIES)
+        if result.returncode != 0:
+            return "failed", result.output
+        head_after = run_git(dir, "rev-parse", "HEAD").stdout
+        return "ok" if head_before != head_after else "unchanged", result.output
+
+    repos = load_repos()
+    if command.options["shared"]:
+        update_shared_objects(repos, command.options["jobs"])
+    print_repo_results(run_repos(pull_repo, repos, command.options["jobs"]))
 
 
 # MARK: COMMAND saveh
-def save_hashes(command: Command, args: list[str]):
-    import git
+def resolve_head(dir: str):
+    # NOTE(blackedout): Reads the HEAD commit hash from .git/HEAD, loose refs and packed-refs without starting git.
+    # Returns None for anything else (e.g. worktrees where .git is a file, reftable or nested symbolic refs)
+    git_dir = os.path.join(dir, ".git")
+    if not os.path.isdir(git_dir):
+        return None
+    with open(os.path.join(git_dir, "HEAD")) as file:
+        head = file.read().strip()
+    if not head.startswith("ref: "):
+        return head if re.fullmatch(r"[0-9a-f]{40}|[0-9a-f]{64}", head) else None
+
+    ref = head[len("ref: "):]
+    ref_path = os.path.join(git_dir, ref)
+    if os.path.isfile(ref_path):
+        with open(ref_path) as file:
+            commit_hash = file.read().strip()
+        return commit_hash if re.fullmatch(r"[0-9a-f]{40}|[0-9a-f]{64}", commit_hash) else None
+
+    packed_refs_path = os.path.join(git_dir, "packed-refs")
+    if os.path.isfile(packed_refs_path):
+        with open(packed_refs_path) as file:
+            for line in file:
+                if line.startswith(("#", "^")):
+                    continue
+                commit_hash, _, name = line.strip().partition(" ")
+                if name == ref:
+                    return commit_hash
+    return None
+
+
+def parse_deadline(arg: str):
+    # NOTE(blackedout): Unix timestamp or ISO 8601 date, e.g. "2026-10-17 23:59" (local time unless an offset is given)
+    from datetime import datetime
+    try:
+        return float(arg)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(arg).timestamp()
+    except ValueError:
+        print_exit(f"'{arg}' is not a valid deadline, must be a unix timestamp or an ISO 8601 date.")
+
+
+def resolve_deadline_commit(dir: str, deadline: float):
+    # NOTE(blackedout): A single walk along the first parents (newest first) of the fetched main branch, local main or HEAD.
+    # Returns the newest commit with a committer date at or before the deadline, the commit dates of the ones after it and an error message
+    for ref in DEADLINE_REFS:
+        result = run_git(dir, "rev-list", "--first-parent", "--timestamp", ref, "--")
+        if result.returncode == 0:
+            break
+    else:
+        return None, [], f"None of {', '.join(DEADLINE_REFS)} exists in {dir}.\n{result.output.strip()}"
+
+    late_timestamps = []
+    for line in result.stdout.splitlines():
+        try:
+            timestamp, commit_hash = line.split(" ", 1)
+            timestamp = int(timestamp)
+        except ValueError:
+            return None, late_timestamps, f"Unexpected git rev-list output '{line}' in {dir}."
+        if timestamp <= deadline:
+            return commit_hash, late_timestamps, None
+        late_timestamps.append(timestamp)
+    return None, late_timestamps, f"Could not resolve the last commit before the deadline of {dir}."
 
-    blatt_num = parse_sheet_number(args[0])
 
-    repos = json.load(open(REPOS_JSON_FILENAME))
-    for repo in repos:
-        dir = repo["name"].split()[0]
-        print(dir)
+def save_hashes(command: Command, args: list[str]):
+    blatt_num = parse_sheet_number(args[0])
+    deadline = parse_deadline(command.options["deadline"]) if command.options["deadline"] is not None else None
+
+    def get_hash(repo: dict):
+        dir = repo_dirname(repo)
+        if deadline is not None:
+            return resolve_deadline_commit(dir, deadline)
+        commit_hash = resolve_head(dir)
+        if commit_hash is None and os.path.exists(os.path.join(dir, ".git")):
+            result = run_git(dir, "rev-parse", "--verify", "HEAD")
+            commit_hash = result.stdout.strip() if result.returncode == 0 else None
+        return commit_hash, [], f"Could not resolve the HEAD commit of {dir}." if commit_hash is None else None
+
+    connection = open_state()
+    repos = load_repos(connection)
+    with TRACER.span("resolve hashes", count=len(repos)), ThreadPoolExecutor(max_workers=max(command.options["jobs"], 1)) as executor:
+        resolved = list(executor.map(get_hash, repos))
+
+    # NOTE(blackedout): Nothing is written unless the hashes of all repos could be saved
+    errors = []
+    late_rows = []
+    for repo, (commit_hash, late_timestamps, error) in zip(repos, resolved):
+        dir = repo_dirname(repo)
+        late_string = f" ({len(late_timestamps)} commits after the deadline)" if late_timestamps else ""
+        print(f"{dir} {commit_hash}{late_string}")
+        if str(blatt_num) in repo and not command.options["force"]:
+            errors.append(f"Commit hash for sheet {blatt_num} already saved for {dir}.")
+        elif error is not None:
+            errors.append(error)
+        if late_timestamps:
+            late_rows.append((repo["dirname"], blatt_num, deadline, len(late_timestamps), max(late_timestamps)))
+    if errors:
+        print_exit("\n".join(errors))
+
+    with connection:
+        connection.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?)", [(repo["dirname"], blatt_num, commit_hash) for repo, (commit_hash, _, _) in zip(repos, resolved)])
+        connection.execute("DELETE FROM late_commits WHERE sheet = ?", (blatt_num,))
+        connection.executemany("INSERT INTO late_commits VALUES (?, ?, ?, ?, ?)", late_rows)
+    if late_rows:
+        print(f"\n{len(late_rows)} repositories have commits after the deadline: {', '.join([row[0] for row in late_rows])}")
 
-        g = git.Git(dir)
-        commit_hash = g.log("--format=%H", "-n 1")
-        if str(blatt_num) in repo:
-            print_exit(f"Commit hash for sheet {blatt_num} already saved.")
-        else:
-            repo[str(blatt_num)] = commit_hash
 
-    with open(REPOS_JSON_FILENAME, "w", encoding="utf-8") as file:
-        json.dump(repos, file, ensure_ascii=False, indent=4)
+# MARK: COMMAND commit
+class GitSteps:
+    # NOTE(blackedout): Runs the git steps of one repo and keeps the exit code and output of every step that ran for the report
+    def __init__(self, dir: str):
+        self.dir = dir
+        self.log = []
+
+    def __call__(self, *args: str, retries: int=0, env: dict|None=None):
+        result = run_git(self.dir, *args, retries=retries, env=env)
+        self.log.append(f"$ git {' '.join(args)} (exit {result.returncode})\n{result.output}")
+        return result
+
+    def result(self, status: str):
+        return status, "\n".join(self.log)
+
+
+def commit_repo(dir: str, sheet_number: int):
+    # NOTE(blackedout): Runs the git steps needed to commit and push the README.md (and pdf files) of one group.
+    # Stops at the first step that failed, the output contains the exit code and output of every step that ran.
+    step = GitSteps(dir)
+    stash_before = step("rev-parse", "-q", "--verify", "refs/stash").stdout
+    if step("stash").returncode != 0:
+        return step.result("failed")
+    has_stashed = step("rev-parse", "-q", "--verify", "refs/stash").stdout != stash_before
+    if step("pull", retries=GIT_RETRIES).returncode != 0:
+        # NOTE(blackedout): The rendered README.md and local changes must not stay behind in the stash
+        if has_stashed:
+            restored = step("stash", "pop").returncode == 0
+            step.log.append("Restored the stashed changes." if restored else "Could not restore the stashed changes, they are still in the stash.")
+        return step.result("failed")
+    if has_stashed and step("stash", "pop").returncode != 0:
+        return step.result("failed")
+
+    pdf_paths = [path for path in step("ls-files", "-z", "-m", "-o", "--exclude-standard", "--", "*.pdf").stdout.split("\0") if path]
+    if step("add", "README.md", *pdf_paths).returncode != 0:
+        return step.result("failed")
+    if step("restore", ".").returncode != 0:
+        return step.result("failed")
+
+    if step("diff", "--cached", "--quiet").returncode != 0:
+        if step("commit", "-m", f"{CORRECTION_STRING} {SHEET_STRING} {sheet_number}").returncode != 0:
+            return step.result("failed")
+    elif step("rev-list", "--count", "@{u}..HEAD").stdout.strip() == "0":
+        return step.result("unchanged")
+
+    if step("push", "-u", "origin", "main", retries=GIT_RETRIES).returncode != 0:
+        return step.result("failed")
+    return step.result("pushed")
+
+
+def commit_repo_plumbing(dir: str, sheet_number: int, bew_strings: list[str], scores: list[Score]):
+    # NOTE(blackedout): Same result as commit_repo, but the commit is built from objects on top of the fetched remote main
+    # (README.md and changed pdf files are hashed into a temporary index), so the working tree, index and local branches are never touched.
+    # The README is rendered again on top of the fetched one, so changes the students pushed since the last pull are kept
+    step = GitSteps(dir)
+    remote_ref = "refs/remotes/origin/main"
+    if step("fetch", "origin", f"+refs/heads/main:{remote_ref}", retries=GIT_RETRIES).returncode != 0:
+        return step.result("failed")
+    base = step("rev-parse", "--verify", remote_ref)
+    if base.returncode != 0:
+        return step.result("failed")
+    base_hash = base.stdout.strip()
+    base_readme = step("show", f"{base_hash}:README.md")
+    if base_readme.returncode != 0:
+        return step.result("failed")
+
+    # NOTE(blackedout): .git is a file in worktrees, so the git directory is asked for
+    git_dir = step("rev-parse", "--git-dir")
+    if git_dir.returncode != 0:
+        return step.result("failed")
+    index_path = os.path.join(dir, git_dir.stdout.strip(), f"tutorstuff-index-{sheet_number}")
+    readme_path = os.path.join(dir, git_dir.stdout.strip(), f"tutorstuff-README-{sheet_number}.md")
+    env = { "GIT_INDEX_FILE": os.path.abspath(index_path) }
+    try:
+        with open(readme_path, "w") as file:
+            file.write(render_readme(base_readme.stdout, bew_strings, scores))
+        # NOTE(blackedout): --path applies the filters (e.g. core.autocrlf) of README.md to the rendered file
+        readme_blob = step("hash-object", "-w", "--path=README.md", "--", os.path.abspath(readme_path))
+        if readme_blob.returncode != 0:
+            return step.result("failed")
+        pdf_paths = [path for path in step("ls-files", "-z", "-m", "-o", "--exclude-standard", "--", "*.pdf").stdout.split("\0") if path]
+        pdf_blobs = step("hash-object", "-w", "--", *pdf_paths) if pdf_paths else None
+        if pdf_blobs is not None and pdf_blobs.returncode != 0:
+            return step.result("failed")
+        blob_hashes = readme_blob.stdout.split() + (pdf_blobs.stdout.split() if pdf_blobs else [])
+        paths = ["README.md", *pdf_paths]
+        if len(blob_hashes) != len(paths):
+            return step.result("failed")
+
+        if step("read-tree", base_hash, env=env).returncode != 0:
+            return step.result("failed")
+        cache_infos = [f"100644,{blob},{path}" for blob, path in zip(blob_hashes, paths)]
+        if step("update-index", "--add", *[arg for info in cache_infos for arg in ("--cacheinfo", info)], env=env).returncode != 0:
+            return step.result("failed")
+        tree = step("write-tree", env=env)
+        if tree.returncode != 0:
+            return step.result("failed")
+    finally:
+        for path in (index_path, readme_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    tree_hash = tree.stdout.strip()
+    if tree_hash == step("rev-parse", f"{base_hash}^{{tree}}").stdout.strip():
+        return step.result("unchanged")
+    commit = step("commit-tree", tree_hash, "-p", base_hash, "-m", f"{CORRECTION_STRING} {SHEET_STRING} {sheet_number}")
+    if commit.returncode != 0:
+        return step.result("failed")
+    if step("push", "origin", f"{commit.stdout.strip()}:refs/heads/main", retries=GIT_RETRIES).returncode != 0:
+        return step.result("failed")
+    return step.result("pushed")
+
+
+def has_pending_pdfs(dir: str):
+    # NOTE(blackedout): Pdf files that commit would add, counts as pending if git failed so that the error shows up when committing
+    result = run_git(dir, "ls-files", "-z", "-m", "-o", "--exclude-standard", "--", "*.pdf")
+    return result.returncode != 0 or result.stdout != ""
 
 
-# MARK: COMMAND commit
 def commit_repos(command: Command, args: list[str]):
-    @dataclass
-    class GroupData:
-        bew_strings: list[str]
-        scores: list[Score]
-
     sheet_number = parse_sheet_number(args[0])
 
-    repos = json.load(open(REPOS_JSON_FILENAME))
-    for repo in repos:
-        repo["dirname"] = repo["name"].split(" ")[0]
-    group_data = { repo["dirname"]: GroupData([], []) for repo in repos }
-    group_names = { repo["dirname"]: repo["name"] for repo in repos }
-
-    for i in range(1, sheet_number + 1):
-        bew_strings, scores = parse_bew_file(i)
+    repos = load_repos()
+    group = command.options["group"]
+    if group is not None:
+        repos = [repo for repo in repos if repo["dirname"] == group]
+        if not repos:
+            print_exit(f"ERROR: Unknown group {group}")
+    group_bew_strings = { repo["dirname"]: [] for repo in repos }
+
+    with open_state() as connection, TRACER.span("load sheets", count=sheet_number):
+        if group is None:
+            parsed_sheets = [parse_bew_file_cached(i, connection) for i in range(1, sheet_number + 1)]
+        else:
+            parsed_sheets = [parse_group_section(i, group, connection) for i in range(1, sheet_number + 1)]
 
+    for i, (bew_strings, scores) in enumerate(parsed_sheets, 1):
         for repo in repos:
             repo_dirname = repo["dirname"]
             if repo_dirname not in bew_strings:
@@ -324,79 +1111,327 @@ def commit_repos(command: Command, args: list[str]):
                 print_exit(f"ERROR: Missing commit hash for group {repo_dirname}")
             
             commit_hash = repo[str(i)]
-            bew_string = bew_strings[repo_dirname].replace("Commit \n", f"Commit {commit_hash}\n")
-            group_data[repo_dirname].bew_strings.append(bew_string)
-            group_data[repo_dirname].scores.append(scores[repo_dirname])
-
-    for repo_dirname, data in group_data.items():
-        readme_start = ""
-        readme_path = os.path.join(repo_dirname, "README.md")
-        with open(readme_path, "r") as file:
-            lines = file.readlines()
-            for line in lines:
-                bew_start_match = re.match(rf"### (?:{SHEET_STRING} \d+|{TOTAL_SCORE_STRING})", line)
-                if bew_start_match:
-                    break
-                readme_start += line
-
-        if args[1] == "SUMMARY":
-            print(group_names[repo_dirname])
-            gen_markdown_lr(data.scores, add_master_points=False, append_note=False, print_summary=True)
+            bew_string = insert_commit_hash(bew_strings[repo_dirname], commit_hash)
+            group_bew_strings[repo_dirname].append(bew_string)
+
+    if args[1] == "SUMMARY":
+        with TRACER.span("ScoreMatrix"):
+            matrix = ScoreMatrix([repo["dirname"] for repo in repos], [scores for _, scores in parsed_sheets])
+        print_score_summary(matrix, [repo["name"] for repo in repos])
+        if command.options["csv"]:
+            matrix.write_csv(command.options["csv"])
+        if command.options["json"]:
+            with open(command.options["json"], "w", encoding="utf-8") as file:
+                json.dump(matrix.to_json(), file, ensure_ascii=False, indent=4)
+        return
+
+    # NOTE(blackedout): READMEs are rendered in memory and only written if their content changed,
+    # in COMMIT mode only repos whose README differs from the one that was last pushed for this sheet are committed (unless --force)
+    readme_hashes = {}
+    written_count = 0
+    with TRACER.span("render readmes", count=len(repos)):
+        for repo in repos:
+            repo_dirname = repo["dirname"]
+            readme_hashes[repo_dirname], is_written = update_readme(repo_dirname, group_bew_strings[repo_dirname], [scores[repo_dirname] for _, scores in parsed_sheets])
+            if is_written:
+                print(os.path.join(repo_dirname, "README.md"))
+                written_count += 1
+    print(f"{written_count} README.md files written, {len(repos) - written_count} unchanged")
+
+    if args[1] == "COMMIT":
+        with open_state() as connection:
+            pushed_hashes = dict(connection.execute("SELECT dirname, sha256 FROM readme_pushes WHERE sheet = ? AND status != 'failed'", (sheet_number,)).fetchall())
+        pushed_repos = [repo for repo in repos if not command.options["force"] and pushed_hashes.get(repo["dirname"]) == readme_hashes[repo["dirname"]]]
+        with TRACER.span("check pdfs", count=len(pushed_repos)), ThreadPoolExecutor(max_workers=max(command.options["jobs"], 1)) as executor:
+            skipped_dirnames = { repo["dirname"] for repo, has_pdfs in zip(pushed_repos, executor.map(lambda repo: has_pending_pdfs(repo["dirname"]), pushed_repos)) if not has_pdfs }
+        changed_repos = [repo for repo in repos if repo["dirname"] not in skipped_dirnames]
+        print(f"Skipping {len(skipped_dirnames)} repos whose README.md was already pushed and without new pdf files (use --force to commit them anyway)")
+
+        if command.options["plumbing"]:
+            commit_function = lambda repo: commit_repo_plumbing(repo["dirname"], sheet_number, group_bew_strings[repo["dirname"]], [scores[repo["dirname"]] for _, scores in parsed_sheets])
         else:
-            print_instead_of_readme = False
-            if print_instead_of_readme:
-                x = ""
-                x += (readme_start)
-                x += gen_markdown_lr(data.scores, add_master_points=False, append_note=False)
-                for bew_string in reversed(data.bew_strings):
-                    x += ("\n\n" + bew_string + "\n")
-                x += ("\n")
-                print(x)
-            else:
-                print(readme_path)
-                with open(readme_path, "w") as file:
-                    file.write(readme_start)
-                    file.write(gen_markdown_lr(data.scores, add_master_points=False, append_note=False))
-                    for bew_string in reversed(data.bew_strings):
-                        file.write("\n\n" + bew_string)
-                    file.write("\n")
-
-            if args[1] == "COMMIT":
-                cd_prefix = f"cd {repo_dirname} &&"
-                #os.system(f"{cd_prefix} git checkout korrektur || git checkout -b korrektur")
-                os.system(f"{cd_prefix} git stash")
-                os.system(f"{cd_prefix} git pull")
-                os.system(f"{cd_prefix} git stash pop")
-
-                os.system(f"{cd_prefix} git add README.md \\*.pdf")
-                os.system(f"{cd_prefix} git restore .")
-                os.system(f"{cd_prefix} git commit -m \"{CORRECTION_STRING} {SHEET_STRING} {sheet_number}\"")
-                os.system(f"{cd_prefix} git push -u origin main")
+            commit_function = lambda repo: commit_repo(repo["dirname"], sheet_number)
+        results = run_repos(commit_function, changed_repos, command.options["jobs"])
+        with open_state() as connection:
+            for result in results:
+                connection.execute("INSERT OR REPLACE INTO readme_pushes VALUES (?, ?, ?, ?, ?)", (result.dirname, sheet_number, readme_hashes[result.dirname], result.status, time.time()))
+        print_repo_results(results)
 
 
-# MARK: COMMAND rmd
-def create_ratings_md(command: Command, args: list[str]):
-    sheet_number = args[0]
+# MARK: COMMAND watch
+def watch_ratings(command: Command, args: list[str]):
+    sheet_number = parse_sheet_number(args[0])
+    repos = { repo["dirname"]: repo for repo in load_repos() }
+    with open_state() as connection:
+        earlier_sheets = [parse_bew_file_cached(i, connection) for i in range(1, sheet_number)]
+
+    def update_group(group: str, record: tuple[str, Score]):
+        repo = repos[group]
+        bew_strings = []
+        scores = []
+        for i, (sheet_bew_strings, sheet_scores) in enumerate(earlier_sheets + [({ group: record[0] }, { group: record[1] })], 1):
+            if group not in sheet_bew_strings or str(i) not in repo:
+                print(f"ERROR: Missing rating or commit hash of sheet {i} for group {group}")
+                return False
+            bew_strings.append(insert_commit_hash(sheet_bew_strings[group], repo[str(i)]))
+            scores.append(sheet_scores[group])
+        return update_readme(group, bew_strings, scores)[1]
+
+    # NOTE(blackedout): Only the sections of groups whose text changed since the last check are parsed and rendered again
+    path = ratings_md_filename(sheet_number)
+    sections = {}
+    last_mtime = None
+    print(f"Watching '{path}', stop with Ctrl+C")
     try:
-        sheet_number = int(sheet_number)
-    except:
-        print_exit(f"Invalid sheet number '{sheet_number}' (not an integer).")
+        while True:
+            mtime = os.stat(path).st_mtime_ns if os.path.exists(path) else None
+            if mtime is not None and mtime != last_mtime:
+                last_mtime = mtime
+                start = time.perf_counter()
+                with open(path, "r") as file:
+                    new_sections = split_group_sections(file.readlines())
+
+                changed_groups = [group for group, (_, lines) in new_sections.items() if sections.get(group) != lines]
+                updated_count = 0
+                for group in changed_groups:
+                    first_line_number, lines = new_sections[group]
+                    sections[group] = lines
+                    for record_group, bew_string, score in parse_bew_lines(lines, sheet_number, first_line_number):
+                        if record_group not in repos:
+                            print(f"Unknown group {record_group} (line {first_line_number})")
+                        elif update_group(record_group, (bew_string, score)):
+                            print(os.path.join(record_group, "README.md"))
+                            updated_count += 1
+                if changed_groups:
+                    print(f"{len(changed_groups)} changed sections, {updated_count} README.md files written in {time.perf_counter() - start:.3f}s")
+            time.sleep(WATCH_INTERVAL)
+    except KeyboardInterrupt:
+        print()
 
-    task_summary_lines = ["|" for _ in range(3)]
-    task_details = ""
-    
-    def append_task(task_name, task_points):
-        task_points_string = POINTS_TO_STRING(task_points)
-        task_points_zero = f"**{POINTS_TO_STRING(POINTS_FROM_STRING("0"))}/{task_points_string}**"
-        task_points_max = f"**{task_points_string}/{task_points_string}**"
-        max_length = max(len(task_name), len(task_points_max))
-
-        task_summary_lines[0] += f" {task_name:^{max_length}} |"
-        task_summary_lines[1] += f" :{'-'*(max_length - 2)}: |"
-        task_summary_lines[2] += f" {task_points_zero:^{max_length - (len(task_points_max) - len(task_points_zero))}} |"
-
-    points_sum = POINTS_FROM_STRING("0")
-    for task_arg in args[1:]:
+
+# MARK: COMMAND test
+def prepare_worktree(dir: str, commit_hash: str):
+    worktree_dir = os.path.abspath(os.path.join(TEST_WORKTREES_DIRNAME, dir))
+    if os.path.exists(worktree_dir):
+        result = run_git(worktree_dir, "checkout", "-q", "--detach", "--force", commit_hash)
+        if result.returncode == 0:
+            result = run_git(worktree_dir, "clean", "-q", "-ffdx")
+    else:
+        result = run_git(dir, "worktree", "add", "-q", "--detach", worktree_dir, commit_hash)
+    return worktree_dir, result
+
+
+def run_test(worktree_dir: str, test_command: str, timeout: int):
+    # NOTE(blackedout): The limits are set with ulimit in the shell that runs the test, the whole process group is killed on timeout
+    limits = []
+    if TEST_CPU_LIMIT > 0:
+        limits.append(f"ulimit -t {TEST_CPU_LIMIT}")
+    if TEST_MEMORY_LIMIT > 0:
+        limits.append(f"ulimit -v {TEST_MEMORY_LIMIT//1024}")
+    process = subprocess.Popen(" && ".join(limits + [f"({test_command})"]), shell=True, cwd=worktree_dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, text=True, start_new_session=True)
+    try:
+        output, _ = process.communicate(timeout=timeout if timeout > 0 else None)
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            # NOTE(blackedout): The process group ended right after the timeout
+            pass
+        output, _ = process.communicate()
+        return "timeout", output
+    return "passed" if process.returncode == 0 else "failed", output
+
+
+def center_cell(content: str, width: int):
+    return f" {content} ".center(width)
+
+
+def prefill_ratings_md(sheet_number: int, group_points: dict[str, dict[int, float]]):
+    # NOTE(blackedout): Only task cells that are still at 0 points are filled in, the total is recomputed from all task cells
+    filename = ratings_md_filename(sheet_number)
+    with open(filename, "r") as file:
+        lines = file.readlines()
+
+    filled_count = 0
+    for group, (first_line_number, section_lines) in split_group_sections(lines).items():
+        points = group_points.get(group)
+        sheet_index = next((i for i, line in enumerate(section_lines) if PATTERNS.sheet.match(line)), None)
+        if not points or sheet_index is None or sheet_index + 3 >= len(section_lines):
+            continue
+        header_cells = section_lines[sheet_index + 1].split("|")[1:-1]
+        points_line_index = first_line_number - 1 + sheet_index + 3
+        points_cells = lines[points_line_index].split("|")[1:-1]
+
+        task_sum = 0.0
+        total_index = None
+        for i, (header_cell, points_cell) in enumerate(zip(header_cells, points_cells)):
+            points_match = PATTERNS.points.search(points_cell)
+            task_match = PATTERNS.task.match(header_cell.strip())
+            if PATTERNS.total.match(header_cell.strip()):
+                total_index = i
+            if not points_match or not task_match:
+                continue
+            this_score = POINTS_FROM_STRING(points_match.group(1))
+            task = int(task_match.group(1))
+            if task in points and this_score == 0.0:
+                this_score = min(points[task], POINTS_FROM_STRING(points_match.group(2)))
+                points_cells[i] = center_cell(f"**{POINTS_TO_STRING(this_score)}/{points_match.group(2)}**", len(points_cell))
+                filled_count += 1
+            task_sum += this_score
+        if total_index is not None:
+            total_match = PATTERNS.points.search(points_cells[total_index])
+            if total_match:
+                points_cells[total_index] = center_cell(f"**{POINTS_TO_STRING(task_sum)}/{total_match.group(2)}**", len(points_cells[total_index]))
+        lines[points_line_index] = "|" + "|".join(points_cells) + "|\n"
+
+    with atomic_write(filename) as file:
+        file.writelines(lines)
+    print(f"Filled in {filled_count} task scores in '{filename}'")
+
+
+def test_repos(command: Command, args: list[str]):
+    sheet_number = parse_sheet_number(args[0])
+    test_command = command.options["command"] or TEST_COMMAND
+    if not test_command:
+        print_exit("No test command, set TEST_COMMAND or use --command.")
+
+    repos = load_repos()
+    missing = [repo["dirname"] for repo in repos if str(sheet_number) not in repo]
+    if missing:
+        print_exit(f"ERROR: Missing commit hash of sheet {sheet_number} for {', '.join(missing)}")
+    with open_state() as connection:
+        cached = { row[:2]: row[2:] for row in connection.execute("SELECT commit_hash, command_sha256, status, output FROM test_results") }
+    os.makedirs(TEST_WORKTREES_DIRNAME, exist_ok=True)
+
+    # NOTE(blackedout): Results are cached by commit hash and test command, so unchanged submissions are never tested twice (unless --force)
+    outputs = {}
+    new_results = {}
+    cached_groups = []
+    def test_repo(repo: dict):
+        commit_hash = repo[str(sheet_number)]
+        group_command = test_command.replace("{group}", repo["dirname"]).replace("{sheet}", str(sheet_number))
+        key = (commit_hash, hashlib.sha256(group_command.encode()).hexdigest())
+        if key in cached and not command.options["force"]:
+            status, output = cached[key]
+            cached_groups.append(repo["dirname"])
+        else:
+            start = time.perf_counter()
+            worktree_dir, result = prepare_worktree(repo["dirname"], commit_hash)
+            if result.returncode != 0:
+                return "failed", result.output
+            status, output = run_test(worktree_dir, group_command, command.options["timeout"])
+            new_results[key] = (status, output, time.perf_counter() - start)
+        outputs[repo["dirname"]] = output
+        return status, output
+
+    results = run_repos(test_repo, repos, command.options["jobs"])
+    with open_state() as connection:
+        for key, (status, output, seconds) in new_results.items():
+            if status != "timeout":
+                connection.execute("INSERT OR REPLACE INTO test_results VALUES (?, ?, ?, ?, ?)", (*key, status, output, seconds))
+    print_repo_results(results)
+    print(f"{len(cached_groups)} results from cache")
+
+    if command.options["prefill"]:
+        task_points_pattern = re.compile(rf"^{TASK_STRING} (\d+): (\d+[,\.]?\d*)\s*$", re.MULTILINE)
+        group_points = {}
+        for group, output in outputs.items():
+            group_points[group] = { int(task): POINTS_FROM_STRING(points) for task, points in task_points_pattern.findall(output) }
+        prefill_ratings_md(sheet_number, group_points)
+
+
+# MARK: COMMAND changes
+def diff_stats(dir: str, from_hash: str, to_hash: str):
+    # NOTE(blackedout): Returns [path, added lines, deleted lines] for every changed file, the line counts are None for binary files
+    result = run_git(dir, "diff", "--numstat", "-z", "--no-renames", from_hash, to_hash)
+    if result.returncode != 0:
+        return None, result.output
+    stats = []
+    for entry in result.stdout.split("\0"):
+        if not entry:
+            continue
+        try:
+            added, deleted, path = entry.split("\t", 2)
+            stats.append([path, None if added == "-" else int(added), None if deleted == "-" else int(deleted)])
+        except ValueError:
+            return None, f"Unexpected git diff --numstat output '{entry}'\n{result.output}"
+    return stats, result.output
+
+
+def format_changes(stats: list):
+    added = sum([s[1] or 0 for s in stats])
+    deleted = sum([s[2] or 0 for s in stats])
+    top_files = sorted(stats, key=lambda s: (s[1] or 0) + (s[2] or 0), reverse=True)[:CHANGES_SUMMARY_FILE_COUNT]
+    files_string = ", ".join([f"{path} (+{a} -{d})" if a is not None else f"{path} (binary)" for path, a, d in top_files])
+    more_string = ", ..." if len(stats) > len(top_files) else ""
+    return f"{len(stats)} files, +{added} -{deleted}" + (f": {files_string}{more_string}" if stats else "")
+
+
+def insert_changes_md(sheet_number: int, summaries: dict[str, str]):
+    # NOTE(blackedout): Puts (or replaces) one comment line with the summary right below the header of each group
+    filename = ratings_md_filename(sheet_number)
+    with open(filename, "r") as file:
+        lines = file.readlines()
+    new_lines = []
+    curr_group = None
+    for line in lines:
+        if curr_group is not None and PATTERNS.changes.match(line):
+            continue
+        new_lines.append(line)
+        matched = PATTERNS.group.match(line)
+        curr_group = matched.group(1) if matched else None
+        if curr_group in summaries:
+            new_lines.append(f"<!-- changes: {summaries[curr_group]} -->\n")
+
+    with atomic_write(filename) as file:
+        file.writelines(new_lines)
+    print(f"Inserted {len(summaries)} change summaries into '{filename}'")
+
+
+def show_changes(command: Command, args: list[str]):
+    sheet_number = parse_sheet_number(args[0])
+    repos = load_repos()
+    missing = [repo["dirname"] for repo in repos if str(sheet_number) not in repo]
+    if missing:
+        print_exit(f"ERROR: Missing commit hash of sheet {sheet_number} for {', '.join(missing)}")
+
+    # NOTE(blackedout): Both hashes are fixed, so the stats of a pair never change and are cached forever
+    with open_state() as connection:
+        cached = { row[:2]: json.loads(row[2]) for row in connection.execute("SELECT from_hash, to_hash, data FROM changes") }
+    empty_tree_hash = run_git(None, "hash-object", "-t", "tree", "--stdin").stdout.strip()
+
+    stats = {}
+    new_stats = {}
+    def repo_changes(repo: dict):
+        key = (repo.get(str(sheet_number - 1), empty_tree_hash), repo[str(sheet_number)])
+        if key in cached:
+            stats[repo["dirname"]] = cached[key]
+            return "cached", ""
+        repo_stats, output = diff_stats(repo["dirname"], *key)
+        if repo_stats is None:
+            return "failed", output
+        stats[repo["dirname"]] = new_stats[key] = repo_stats
+        return "ok", ""
+
+    results = run_repos(repo_changes, repos, command.options["jobs"])
+    with open_state() as connection:
+        connection.executemany("INSERT OR REPLACE INTO changes VALUES (?, ?, ?)", [(*key, json.dumps(value, ensure_ascii=False)) for key, value in new_stats.items()])
+    print_repo_results(results)
+
+    summaries = { group: format_changes(group_stats) for group, group_stats in stats.items() }
+    print()
+    for repo in repos:
+        if repo["dirname"] in summaries:
+            print(f"{repo['dirname']}: {summaries[repo['dirname']]}")
+    if command.options["rmd"]:
+        insert_changes_md(sheet_number, summaries)
+
+
+# MARK: COMMAND rmd
+def parse_task_args(command: Command, task_args: list[str]):
+    # NOTE(blackedout): Returns a (task name, subtasks, points) tuple for every task argument
+    tasks = []
+    for task_arg in task_args:
         task_split = task_arg.split(":")
         if len(task_split) != 3:
             print_exit(f"Task argument '{task_arg}' invalid (format must be <{command.arg_names[1]}>).")
@@ -405,81 +1440,268 @@ def create_ratings_md(command: Command, args: list[str]):
             points = POINTS_FROM_STRING(points)
         except:
             print_exit(f"Task points '{points}' invalid.")
-        points_sum += points
-
-        task_name = f"{TASK_STRING} {task}"
-        append_task(task_name, points)
-
-        task_details += f"#### {task_name}"
-        breaker = ""
-        if subtasks == "FILE":
-            task_details += f"\n{SEE_PDF_STRING}"
+        tasks.append((f"{TASK_STRING} {task}", subtasks, points))
+    return tasks
+
+
+def task_table_lines(columns: list[tuple[str, str, int]]):
+    # NOTE(blackedout): Columns are (header, points cell, width) tuples
+    lines = ["|" for _ in range(3)]
+    for name, points_cell, width in columns:
+        lines[0] += f" {name:^{width}} |"
+        lines[1] += f" :{'-'*(width - 2)}: |"
+        lines[2] += f" {points_cell:^{width}} |"
+    return [f"{line}\n" for line in lines]
+
+
+def task_column(name: str, points: float, max_points: float):
+    max_points_string = POINTS_TO_STRING(max_points)
+    return name, f"**{POINTS_TO_STRING(points)}/{max_points_string}**", max(len(name), len(f"**{max_points_string}/{max_points_string}**"))
+
+
+def task_details_lines(task_name: str, subtasks: str):
+    lines = [f"#### {task_name}\n"]
+    if subtasks == "FILE":
+        lines.append(f"{SEE_PDF_STRING}\n")
+    else:
+        lines += [f"{'<br/>' if i > 0 else ''}**{subtask})**\n" for i, subtask in enumerate(subtasks)]
+    return lines + ["\n"]
+
+
+def ratings_template_lines(sheet_number: int, tasks: list[tuple[str, str, float]]):
+    columns = [task_column(name, 0.0, points) for name, _, points in tasks]
+    columns.append(task_column(TOTAL_STRING, 0.0, sum([points for _, _, points in tasks])))
+    lines = [f"### {SHEET_STRING} {sheet_number}\n", *task_table_lines(columns), "\n", "Commit \n", "\n"]
+    for name, subtasks, _ in tasks:
+        lines += task_details_lines(name, subtasks)
+    return lines + ["\n"]
+
+
+def merge_group_section(section_lines: list[str], tasks: list[tuple[str, str, float]]):
+    # NOTE(blackedout): Brings the task table and task headers of an existing group section up to date with the task arguments.
+    # Points that were already given are kept (capped to the new maximum), as are other columns (e.g. the master points) and all text.
+    # Returns None if the section already matches or its task table cannot be read
+    p = PATTERNS
+    group = p.group.match(section_lines[0]).group(1)
+    sheet_index = next((i for i, line in enumerate(section_lines) if p.sheet.match(line)), None)
+    if sheet_index is None or sheet_index + 3 >= len(section_lines):
+        print(f"Section of {group} has no task table, left unchanged.")
+        return None
+    header_cells = p.cell_separator.split(section_lines[sheet_index + 1])[1:-1]
+    points_cells = p.cell_separator.split(section_lines[sheet_index + 3])[1:-1]
+    if len(header_cells) != len(points_cells):
+        print(f"Task table of {group} has {len(header_cells)} columns but {len(points_cells)} points, left unchanged.")
+        return None
+
+    old_points = {}
+    other_columns = ([], [])
+    is_after_total = False
+    for name, points_cell in zip(header_cells, points_cells):
+        points_match = p.points.match(points_cell)
+        if p.task.match(name) and not points_match:
+            print(f"Invalid points '{points_cell}' of {name} in the task table of {group}, left unchanged.")
+            return None
+        elif p.task.match(name):
+            old_points[name] = (POINTS_FROM_STRING(points_match.group(1)), POINTS_FROM_STRING(points_match.group(2)))
+        elif p.total.match(name):
+            is_after_total = True
         else:
-            for subtask in subtasks:
-                task_details += f"\n{breaker}**{subtask})**"
-                breaker = "<br/>"
-        task_details += "\n\n"
-
-    append_task(TOTAL_STRING, points_sum)
-
-    template_string = f"### {SHEET_STRING} {sheet_number}\n"
-    for a in task_summary_lines:
-        template_string += f"{a}\n"
-    template_string += f"\nCommit \n\n"
-    template_string += task_details + "\n"
+            other_columns[is_after_total].append((name, points_cell, max(len(name), len(points_cell))))
+
+    task_headers = [line.strip() for line in section_lines if line.startswith("#### ")]
+    missing_tasks = [(name, subtasks) for name, subtasks, _ in tasks if f"#### {name}" not in task_headers]
+    if [(name, max_points) for name, (_, max_points) in old_points.items()] == [(name, points) for name, _, points in tasks] and not missing_tasks:
+        return None
+
+    columns = [task_column(name, min(old_points.get(name, (0.0,))[0], points), points) for name, _, points in tasks]
+    points_sum = sum([min(old_points.get(name, (0.0,))[0], points) for name, _, points in tasks])
+    columns += other_columns[0]
+    columns.append(task_column(TOTAL_STRING, points_sum, sum([points for _, _, points in tasks])))
+    columns += other_columns[1]
+    lines = section_lines[:sheet_index + 1] + task_table_lines(columns) + section_lines[sheet_index + 4:]
+
+    # NOTE(blackedout): New tasks go in front of the first task with a higher number, otherwise behind the last text of the section
+    def task_number(name: str):
+        task_match = p.task.search(name)
+        return int(task_match.group(1)) if task_match else sys.maxsize
+
+    for name, subtasks in missing_tasks:
+        index = next((i for i, line in enumerate(lines) if line.startswith("#### ") and task_number(line) > task_number(name)), None)
+        if index is not None:
+            lines[index:index] = task_details_lines(name, subtasks)
+        else:
+            index = max([i + 1 for i, line in enumerate(lines) if line.strip()])
+            lines[index:index] = ["\n", *task_details_lines(name, subtasks)[:-1]]
+    return lines
 
-    md_string = f"# Template\n\n{template_string}"
-    repos = json.load(open(REPOS_JSON_FILENAME))
-    for repo in repos:
-        dir = repo["name"].split()[0]
-        md_string += f"# {dir}\n\n{template_string}"
 
-    ratings_md_filename = f"{RATINGS_FILEPREFIX}{sheet_number:02d}.md"
-    if os.path.exists(ratings_md_filename):
-        print(f"File '{ratings_md_filename}' does already exist.")
+def create_ratings_md(command: Command, args: list[str]):
+    sheet_number = parse_sheet_number(args[0])
+    tasks = parse_task_args(command, args[1:])
+    template_lines = ratings_template_lines(sheet_number, tasks)
+    repos = load_repos()
+
+    filename = ratings_md_filename(sheet_number)
+    sections = {}
+    if os.path.exists(filename) and command.options["overwrite"]:
+        print(f"File '{filename}' does already exist.")
         i = input("Overwrite [Y]? ")
         if i != "Y":
             sys.exit()
-    with open(ratings_md_filename, "w") as ratings_md_file:
-        ratings_md_file.write(md_string)
+    elif os.path.exists(filename):
+        with open(filename, "r") as file:
+            sections = split_group_sections(file.readlines())
+
+    # NOTE(blackedout): Written group by group into a temporary file that replaces the rating file once complete.
+    # Existing sections are merged in file order (also those of groups that are no longer in the repos), new groups are appended
+    updated_count = 0
+    added_count = 0
+    with atomic_write(filename) as file:
+        file.write("# Template\n\n")
+        file.writelines(template_lines)
+        for group, (_, section_lines) in sections.items():
+            merged_lines = merge_group_section(section_lines, tasks)
+            updated_count += merged_lines is not None
+            file.writelines(merged_lines or section_lines)
+            if not (merged_lines or section_lines)[-1].endswith("\n"):
+                file.write("\n")
+        for repo in repos:
+            dir = repo_dirname(repo)
+            if dir not in sections:
+                file.write(f"# {dir}\n\n")
+                file.writelines(template_lines)
+                added_count += 1
+
+    if sections:
+        print(f"'{filename}': {len(sections) - updated_count} sections unchanged, {updated_count} updated, {added_count} added")
+
+
+# MARK: COMMAND state
+def state_command(command: Command, args: list[str]):
+    with open_state() as connection:
+        if args[0] == "import":
+            import_repos_json(connection)
+        elif args[0] == "export":
+            export_repos_json(connection)
+        else:
+            print_exit(f"Unknown state action '{args[0]}', must be import or export.")
+
+
+# MARK: COMMAND cache
+def cache_command(command: Command, args: list[str]):
+    with open_state() as connection:
+        if args[0] == "stats":
+            config = parse_config_key()
+            rows = connection.execute("SELECT path, size, mtime_ns, config, length(data) FROM sheet_cache ORDER BY path").fetchall()
+            for path, size, mtime_ns, row_config, data_size in rows:
+                is_valid = row_config == config and os.path.exists(path) and (os.stat(path).st_size, os.stat(path).st_mtime_ns) == (size, mtime_ns)
+                print(f"{path} {size} bytes, {data_size} bytes cached{'' if is_valid else ' (stale)'}")
+            print(f"{len(rows)} cached sheets in '{STATE_FILENAME}'")
+        elif args[0] == "clear":
+            count = connection.execute("DELETE FROM sheet_cache").rowcount
+            print(f"Removed {count} cached sheets")
+        else:
+            print_exit(f"Unknown cache action '{args[0]}', must be stats or clear.")
 
 
 # MARK: MAIN
-if __name__ == "__main__":
+def main(argv: list[str]):
     commands = [
-        Command("get", get_repos, [], False, None),
-        Command("clone", clone_repos, [], False, None),
-        Command("pull", pull_repos, [], False, None),
-        Command("saveh", save_hashes, ["sheet number"], False, "saveh 1"),
-        Command("commit", commit_repos, ["sheet number", "COMMIT if to be committed"], False, None),
-        Command("rmd", create_ratings_md, ["sheet number", "task:subtasks:points"], True, "rmd 1 1:c:1 2:abcd:9 3:FILE:10"),
+        Command("get", get_repos, [], False, "get --jobs 8", { "jobs": DEFAULT_JOBS }),
+        Command("clone", clone_repos, [], False, "clone --jobs 8 --shared --filter blob:limit=1m", { "jobs": DEFAULT_JOBS, "shared": False, "filter": None, "depth": 0 }),
+        Command("pull", pull_repos, [], False, "pull --jobs 8 --shared", { "jobs": DEFAULT_JOBS, "shared": False }),
+        Command("saveh", save_hashes, ["sheet number"], False, "saveh 1 --deadline \"2026-10-17 23:59\"", { "jobs": DEFAULT_JOBS, "deadline": None, "force": False }),
+        Command("commit", commit_repos, ["sheet number", "COMMIT if to be committed"], False, "commit 1 COMMIT --jobs 8", { "jobs": DEFAULT_JOBS, "force": False, "plumbing": False, "csv": None, "json": None, "group": None }),
+        Command("state", state_command, ["import|export"], False, "state export"),
+        Command("cache", cache_command, ["stats|clear"], False, "cache stats"),
+        Command("test", test_repos, ["sheet number"], False, "test 3 --command \"make test\" --prefill", { "jobs": os.cpu_count() or 1, "command": None, "timeout": TEST_TIMEOUT, "force": False, "prefill": False }),
+        Command("changes", show_changes, ["sheet number"], False, "changes 3 --rmd", { "jobs": DEFAULT_JOBS, "rmd": False }),
+        Command("watch", watch_ratings, ["sheet number"], False, "watch 3"),
+        Command("rmd", create_ratings_md, ["sheet number", "task:subtasks:points"], True, "rmd 1 1:c:1 2:abcd:9 3:FILE:10", { "overwrite": False }),
     ]
 
+    def parse_options(command: Command, argv: list[str]):
+        # NOTE(blackedout): Removes all --name [value] options from argv and stores their parsed values in command.options
+        options = dict(command.options)
+        args = []
+        i = 0
+        while i < len(argv):
+            name = argv[i][2:]
+            if not argv[i].startswith("--") or name not in options:
+                if argv[i].startswith("--"):
+                    print(f"Unknown option '{argv[i]}'.")
+                    print_command_usage_exit(command)
+                args.append(argv[i])
+            elif isinstance(command.options[name], bool):
+                options[name] = True
+            else:
+                i += 1
+                if i == len(argv):
+                    print(f"Missing value for option '--{name}'.")
+                    print_command_usage_exit(command)
+                try:
+                    options[name] = type(command.options[name])(argv[i]) if command.options[name] is not None else argv[i]
+                except ValueError:
+                    print(f"Invalid value '{argv[i]}' for option '--{name}'.")
+                    print_command_usage_exit(command)
+            i += 1
+        command.options = options
+        return args
+
     def print_command_usage_exit(command: Command):
         args_string = " ".join([f"<{arg_name}>" for arg_name in command.arg_names])
         repeat_string = "..." if command.repeat_last_arg else ""
-        print(f"Usage: {command.name} {args_string}{repeat_string}")
+        options_string = "".join([f" [--{name}]" if isinstance(default, bool) else f" [--{name} <{name if default is None else default}>]" for name, default in command.options.items()])
+        print(f"Usage: {command.name} {args_string}{repeat_string}{options_string}")
         if command.example_usage:
             print(f"Example: {command.example_usage}")
         sys.exit()
 
-    was_command_found = False
-    command_name = None
-    if len(sys.argv) > 1:
-        command_name = sys.argv[1]
-        for command in commands:
-            if command_name == command.name:
-                if len(sys.argv) < 2 + len(command.arg_names):
-                    print(f"Not enough arguments.")
-                    print_command_usage_exit(command)
-                if not command.repeat_last_arg and len(sys.argv) > 2 + len(command.arg_names):
-                    print(f"Too many arguments.")
-                    print_command_usage_exit(command)
-                command.f(command, sys.argv[2:])
-                was_command_found = True
-    if not was_command_found:
-        error_string = f"Unknown command '{command_name}'" if command_name else "No command specified"
-        commands_string = ", ".join([command.name for command in commands])
-        print_exit(f"{error_string}. Supported are {commands_string}")
+    def run_command(argv: list[str]):
+        was_command_found = False
+        command_name = None
+        if len(argv) > 1:
+            command_name = argv[1]
+            for command in commands:
+                if command_name == command.name:
+                    command_args = parse_options(command, argv[2:])
+                    if len(command_args) < len(command.arg_names):
+                        print(f"Not enough arguments.")
+                        print_command_usage_exit(command)
+                    if not command.repeat_last_arg and len(command_args) > len(command.arg_names):
+                        print(f"Too many arguments.")
+                        print_command_usage_exit(command)
+                    command.f(command, command_args)
+                    was_command_found = True
+        if not was_command_found:
+            error_string = f"Unknown command '{command_name}'" if command_name else "No command specified"
+            commands_string = ", ".join([command.name for command in commands])
+            print_exit(f"{error_string}. Supported are {commands_string}. Global options are --profile and --trace <file>")
+
+    # NOTE(blackedout): Global options that can be put anywhere, e.g. python3 repos.py --profile commit 3 COMMIT
+    argv = list(argv)
+    trace_filename = None
+    if "--profile" in argv:
+        argv.remove("--profile")
+        TRACER.enabled = True
+    if "--trace" in argv:
+        i = argv.index("--trace")
+        if i + 1 == len(argv):
+            print_exit("Missing value for option '--trace'.")
+        trace_filename = argv[i + 1]
+        del argv[i:i + 2]
+        TRACER.enabled = True
+
+    try:
+        with TRACER.span(" ".join(argv[1:])):
+            run_command(argv)
+    finally:
+        if TRACER.enabled:
+            TRACER.print_report(PROFILE_REPORT_COUNT)
+        if trace_filename:
+            TRACER.write_chrome_trace(trace_filename)
+            print(f"Trace written to '{trace_filename}'")
 
 
+if __name__ == "__main__":
+    main(sys.argv)